@@ -1,42 +1,97 @@
+import logging
 import os
+from datetime import datetime
+import time
+import threading
+import orjson
+import pybreaker
 import requests
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, render_template, stream_template, request, redirect, url_for, flash, get_flashed_messages, session
+from flask_caching import Cache
+from apscheduler.schedulers.background import BackgroundScheduler
+from config import SETTINGS, quote_ttl
 from supabase import create_client, Client
 from check_alerts import check_all_alerts
 
 # Imports for Login System
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 
-# IMPORTS for Brevo API
-import brevo_python
-from brevo_python.rest import ApiException
-from brevo_python.models.send_smtp_email import SendSmtpEmail
-
-# Load environment variables from .env file
-load_dotenv()
+# Warnings and up by default, with the alert job's progress at INFO; LOG_LEVEL applies to everything
+logging.basicConfig(level=SETTINGS.log_level or logging.WARNING, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+if SETTINGS.log_level is None:
+    logging.getLogger('check_alerts').setLevel(logging.INFO)
+log = logging.getLogger(__name__)
 
 # Initialize the Flask application
 app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY') 
+# Sessions can't be signed without a secret, so refuse to start rather than fail on first login
+if not SETTINGS.secret_key:
+    raise RuntimeError("Missing required environment variables: SECRET_KEY")
+app.config['SECRET_KEY'] = SETTINGS.secret_key
+
+# Short-lived cache so back-to-back page loads share one watchlist query
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 15})
 
 # Connect to Finnhub
-FINNHUB_API_KEY = os.getenv('FINNHUB_API_KEY')
 FINNHUB_BASE_URL = 'https://finnhub.io/api/v1'
+# Endpoint URLs with the token baked in; only the query value is filled per call
+_QUOTE_URL = f'{FINNHUB_BASE_URL}/quote?symbol={{symbol}}&token={SETTINGS.finnhub_api_key}'
+_SEARCH_URL = f'{FINNHUB_BASE_URL}/search?q={{search_term}}&token={SETTINGS.finnhub_api_key}'
+_SYMBOLS_URL = f'{FINNHUB_BASE_URL}/stock/symbol?exchange=US&token={SETTINGS.finnhub_api_key}'
+
+# One keep-alive session so Finnhub and PostgREST calls reuse their TLS connections.
+# Each host gets a pool larger than the quote fan-out, so no thread waits on a socket.
+SESSION = requests.Session()
+# Finnhub 429s go straight to the breaker; waiting out Retry-After would stall a pool thread.
+# Timeouts aren't retried either, so a hung Finnhub costs one FINNHUB_TIMEOUT per call, not three.
+_FINNHUB_RETRY = Retry(total=2, connect=0, read=0, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+_SUPABASE_RETRY = Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+SESSION.mount('https://finnhub.io', HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=_FINNHUB_RETRY))
+SESSION.mount(SETTINGS.supabase_url, HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=_SUPABASE_RETRY))
+
+# Finnhub calls give up quickly: 2s to connect, 5s to read, so at most ~7s per call when it hangs
+FINNHUB_TIMEOUT = (2, 5)
+
+def _is_client_error(error):
+    """True for 4xx responses (other than 429), which say nothing about Finnhub's health."""
+    response = getattr(error, 'response', None)
+    return response is not None and 400 <= response.status_code < 500 and response.status_code != 429
+
+# Stop calling an endpoint for a minute after 5 straight failures
+_QUOTE_BREAKER = pybreaker.CircuitBreaker(fail_max=5, reset_timeout=60, exclude=[_is_client_error])
+_SEARCH_BREAKER = pybreaker.CircuitBreaker(fail_max=5, reset_timeout=60, exclude=[_is_client_error])
+
+def _finnhub_get(url):
+    """GETs a Finnhub URL, raising on HTTP errors so the breaker can count them."""
+    response = SESSION.get(url, timeout=FINNHUB_TIMEOUT)
+    response.raise_for_status()
+    return response
+
+# Shared pool for fetching quotes concurrently (the calls are I/O-bound)
+_QUOTE_POOL = ThreadPoolExecutor(max_workers=8)
+
+# Quotes are reused for a few seconds (minutes while the market is closed) so page refreshes don't refetch them
+_QUOTE_CACHE = {}  # symbol -> (fetched at, quote)
+_QUOTE_LOCK = threading.Lock()
+
+# Search matches rarely change, so keep them for a day
+SEARCH_TTL_SECS = 24 * 60 * 60
+SEARCH_CACHE_SIZE = 4096
+_SEARCH_CACHE = {}  # search term -> (fetched at, best match)
+_SEARCH_LOCK = threading.Lock()
+
+# Every US ticker and its company name, so typed tickers resolve without a search call
+US_SYMBOLS = {}
 
 # Connect to Supabase
-SUPABASE_URL = os.getenv('SUPABASE_URL')
-SUPABASE_KEY = os.getenv('SUPABASE_KEY')
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# Get Brevo API Credentials
-BREVO_API_KEY = os.getenv('BREVO_API_KEY')
-BREVO_SENDER = os.getenv('BREVO_SENDER') # Validated 'From' email
+supabase: Client = create_client(SETTINGS.supabase_url, SETTINGS.supabase_key)
 
-# Configure Brevo API
-configuration = brevo_python.Configuration()
-configuration.api_key['api-key'] = BREVO_API_KEY
-api_instance = brevo_python.TransactionalEmailsApi(brevo_python.ApiClient(configuration))
+# Hot-path reads go straight to PostgREST over the pooled SESSION
+_POSTGREST_URL = f"{SETTINGS.supabase_url.rstrip('/')}/rest/v1"
+_POSTGREST_HEADERS = {'apikey': SETTINGS.supabase_key, 'Authorization': f'Bearer {SETTINGS.supabase_key}'}
 
 # Login Manager Setup
 login_manager = LoginManager()
@@ -57,115 +112,84 @@ def load_user(user_id):
     email = session.get('email')
     return User(id=user_id, email=email)
 
-# Brevo API Email Function
-def send_email_alert(target_email, symbol, name, alert_type, current_price, target_price):
-    """Builds and sends an HTML email alert using the Brevo API."""
-    
-    if not BREVO_API_KEY or not BREVO_SENDER:
-        print("Brevo keys not set in .env. Skipping email.")
-        return
-
-    if not target_email:
-        print(f"No alert_email set for {symbol}. Skipping email.")
-        return
-
-    # Set dynamic content
-    if alert_type == 'high':
-        subject = f"✅ High Price Alert for {symbol}!"
-        color = "#4CAF50" # Green
-        alert_text = "hit high target"
-    else: # 'low'
-        subject = f"🔻 Low Price Alert for {symbol}!"
-        color = "#dc3545" # Red
-        alert_text = "hit low target"
-        
-    # HTML EMAIL
-    html_content = f"""
-    <html>
-    <head>
-      <style>
-        body {{ font-family: Arial, sans-serif; line-height: 1.6; background-color: #f4f4f4; padding: 20px; }}
-        .container {{ max-width: 600px; margin: auto; background-color: #ffffff; padding: 30px; border-radius: 10px; box-shadow: 0 4px 10px rgba(0,0,0,0.1); }}
-        .header {{ color: #333; text-align: center; }}
-        .alert-title {{ color: {color}; text-align: center; }}
-        .content {{ font-size: 1.1em; color: #555; }}
-        .data-box {{ background-color: #f9f9f9; padding: 15px; border-radius: 5px; text-align: center; font-size: 1.2em; }}
-        .footer {{ color: #888; font-size: 0.9em; text-align: center; margin-top: 20px; }}
-      </style>
-    </head>
-    <body>
-      <div class="container">
-        <h2 class="header">Many As Penny Alert!</h2>
-        <h3 class="alert-title">{symbol} ({name}) {alert_text}</h3>
-        <p class="content">Hello from MAP App,</p>
-        <p class="content">This is an automated alert to let you know that <strong>{symbol}</strong> has reached a price of <strong>${current_price:,.2f}</strong>.</p>
-        <div class="data-box">
-          <p style="margin: 5px 0; color: #333;"><strong>Target Price:</strong> ${target_price:,.2f}</p>
-          <p style="margin: 5px 0; color: {color};"><strong>Current Price:</strong> ${current_price:,.2f}</p>
-        </div>
-        <p class="footer">- MAP App</p>
-      </div>
-    </body>
-    </html>
-    """
-    
-    # Create the email object
-    send_smtp_email = SendSmtpEmail(
-        to=[{"email": target_email}],
-        sender={"email": BREVO_SENDER, "name": "MAP Alert"},
-        subject=subject,
-        html_content=html_content
-    )
-    
-    # Send the email
-    try:
-        api_response = api_instance.send_transac_email(send_smtp_email)
-        print(f"Email sent via Brevo API to {target_email}. Message ID: {api_response.message_id}")
-    except ApiException as e:
-        print(f"Error: Unable to send Brevo email. {e}")
-
-
 # Stock data and profile functions
 def get_stock_quote(symbol):
     """Fetches stock quote data from Finnhub API."""
+    with _QUOTE_LOCK:
+        cached = _QUOTE_CACHE.get(symbol)
+    if cached and time.monotonic() - cached[0] < quote_ttl(SETTINGS.quote_ttl_secs):
+        return cached[1]
+
     try:
-        url = f'{FINNHUB_BASE_URL}/quote?symbol={symbol}&token={FINNHUB_API_KEY}'
-        response = requests.get(url)
-        response.raise_for_status() 
-        data = response.json()
+        url = _QUOTE_URL.format(symbol=symbol)
+        response = _QUOTE_BREAKER.call(_finnhub_get, url)
+        data = orjson.loads(response.content)
         
         # VALIDATION: A successful quote has a current price 'c' that is not 0
         if data.get('c') == 0 and data.get('h') == 0:
-            print(f"Found symbol {symbol} but it has no price data (likely not a valid stock).")
+            log.info("Found symbol %s but it has no price data (likely not a valid stock).", symbol)
             return {'symbol': symbol, 'error': 'No valid price data found for ticker.'}
             
         data['symbol'] = symbol 
-        return {
+        quote = {
             'symbol': symbol, 'current_price': data.get('c'),
             'price_change': data.get('d'), 'percent_change': data.get('dp'),
             'opening_price': data.get('o'), 'high_price': data.get('h'),
             'low_price': data.get('l')
         }
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching quote for {symbol}: {e}")
+        with _QUOTE_LOCK:
+            _QUOTE_CACHE[symbol] = (time.monotonic(), quote)
+        return quote
+    except pybreaker.CircuitBreakerError:
+        log.warning("Skipping quote for %s: Finnhub quote circuit is open.", symbol)
+        return {'symbol': symbol, 'error': 'Quote service is temporarily unavailable.'}
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        log.error("Error fetching quote for %s: %s", symbol, e)
         return {'symbol': symbol, 'error': 'Failed to fetch quote'}
 
 def search_for_stock(search_term):
     """Uses Finnhub Search to find the best match for a search term."""
+    cache_key = search_term.strip().lower()
+    with _SEARCH_LOCK:
+        cached = _SEARCH_CACHE.get(cache_key)
+    if cached and time.monotonic() - cached[0] < SEARCH_TTL_SECS:
+        return cached[1]
+
     try:
-        url = f'{FINNHUB_BASE_URL}/search?q={search_term}&token={FINNHUB_API_KEY}'
-        response = requests.get(url)
-        response.raise_for_status() 
-        data = response.json()
+        url = _SEARCH_URL.format(search_term=search_term)
+        response = _SEARCH_BREAKER.call(_finnhub_get, url)
+        data = orjson.loads(response.content)
         
         if data.get('result') and len(data['result']) > 0:
-            return data['result'][0] 
+            match = data['result'][0]
+            with _SEARCH_LOCK:
+                # Drop the oldest entry once full so the cache can't grow unbounded
+                if cache_key not in _SEARCH_CACHE and len(_SEARCH_CACHE) >= SEARCH_CACHE_SIZE:
+                    _SEARCH_CACHE.pop(next(iter(_SEARCH_CACHE)))
+                _SEARCH_CACHE[cache_key] = (time.monotonic(), match)
+            return match
         else:
             return None
             
-    except requests.exceptions.RequestException as e:
-        print(f"Error searching for stock {search_term}: {e}")
+    except pybreaker.CircuitBreakerError:
+        log.warning("Skipping search for %s: Finnhub search circuit is open.", search_term)
         return None
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        log.error("Error searching for stock %s: %s", search_term, e)
+        return None
+
+
+def refresh_us_symbols():
+    """Downloads Finnhub's list of US tickers used to resolve symbols locally."""
+    global US_SYMBOLS
+    try:
+        response = SESSION.get(_SYMBOLS_URL, timeout=30)
+        response.raise_for_status()
+        rows = orjson.loads(response.content)
+        # Swap in the whole dict at once so readers never see a partial list
+        US_SYMBOLS = {row['symbol']: row.get('description') for row in rows}
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        log.error("Error loading US symbol list: %s", e)
 
 
 # Register Route
@@ -226,27 +250,46 @@ def logout():
     return redirect(url_for('login'))
 
 
+def pg_get(table, params):
+    """Reads rows from a Supabase table through PostgREST using the shared session."""
+    response = SESSION.get(f'{_POSTGREST_URL}/{table}', params=params, headers=_POSTGREST_HEADERS, timeout=(2, 10))
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+@cache.memoize()
+def load_watchlist(user_id):
+    """Fetches a user's stocks along with their alerts."""
+    # Postgres joins each stock to its alerts, so there's one query and no Python-side filtering
+    return pg_get('stocks', {
+        'select': 'id,symbol,name,alerts(*)',
+        'user_id': f'eq.{user_id}',
+        'alerts.user_id': f'eq.{user_id}',
+    })
+
 # Homepage Route
 @app.route('/')
 @login_required 
 def home():
     """Renders the homepage with a list of stock data for the logged-in user."""
     
-    user_id = current_user.id
+    stocks = load_watchlist(current_user.id)
     
-    stocks_response = supabase.table('stocks').select('id, symbol, name').eq('user_id', user_id).execute()
-    stocks = stocks_response.data 
+    if not stocks:
+        return render_template('index.html', stocks=stocks)
     
-    alerts_response = supabase.table('alerts').select('*').eq('user_id', user_id).execute()
-    all_alerts = alerts_response.data
+    # Fetch all quotes in parallel instead of one round-trip after another
+    symbols = [stock['symbol'] for stock in stocks]
+    quotes = _QUOTE_POOL.map(get_stock_quote, symbols)
     
-    for stock in stocks:
-        stock_data = get_stock_quote(stock['symbol'])
+    # Flashes must leave the session before streaming starts, since the cookie goes out with the headers
+    get_flashed_messages()
+    return app.response_class(stream_template('index.html', stocks=_merge_quotes(stocks, quotes)))
+
+def _merge_quotes(stocks, quotes):
+    """Yields each stock with its quote data as soon as that quote arrives."""
+    for stock, stock_data in zip(stocks, quotes):
         stock.update(stock_data) 
-        
-        stock['alerts'] = [alert for alert in all_alerts if alert['stock_id'] == stock['id']]
-            
-    return render_template('index.html', stocks=stocks)
+        yield stock
 
 # Add Stock Function
 @app.route('/add_stock', methods=['POST'])
@@ -259,31 +302,46 @@ def add_stock():
     if not search_term:
         return redirect(url_for('home'))
         
-    stock_data = search_for_stock(search_term)
+    # Users usually type the ticker itself. Until the symbol list has loaded, fetch that
+    # quote while Finnhub search runs; afterwards the local lookup answers first.
+    guessed_symbol = search_term.strip().upper()
+    guessed_quote = None
+    if not US_SYMBOLS and guessed_symbol and ' ' not in guessed_symbol and len(guessed_symbol) <= 6:
+        guessed_quote = _QUOTE_POOL.submit(get_stock_quote, guessed_symbol)
+        
+    # Known tickers come from the local list; only names and unknowns hit Finnhub search
+    if guessed_symbol in US_SYMBOLS:
+        stock_data = {'symbol': guessed_symbol, 'description': US_SYMBOLS[guessed_symbol]}
+    else:
+        stock_data = search_for_stock(search_term)
     
     if stock_data:
         new_symbol = stock_data.get('symbol')
         company_name = stock_data.get('description') 
         
-        test_quote = get_stock_quote(new_symbol)
+        if guessed_quote and new_symbol == guessed_symbol:
+            test_quote = guessed_quote.result()
+        else:
+            test_quote = get_stock_quote(new_symbol)
         
         if test_quote.get('error'):
             flash(f"Found '{new_symbol}' but could not fetch price data. It may be an invalid or non-US ticker.", "error")
             return redirect(url_for('home'))
             
         try:
-            existing = supabase.table('stocks').select('id').eq('symbol', new_symbol).eq('user_id', user_id).execute()
-            if not existing.data:
-                supabase.table('stocks').insert({
-                    'symbol': new_symbol,
-                    'name': company_name,
-                    'user_id': user_id 
-                }).execute()
-            else:
+            # Insert-or-skip in one round-trip; Postgres returns no row if the stock already exists
+            inserted = supabase.table('stocks').upsert({
+                'symbol': new_symbol,
+                'name': company_name,
+                'user_id': user_id 
+            }, on_conflict='user_id,symbol', ignore_duplicates=True).execute()
+            if not inserted.data:
                 flash(f"'{new_symbol}' is already in your list.", "error")
+            else:
+                cache.delete_memoized(load_watchlist, user_id)
                 
         except Exception as e:
-            print(f"Error adding stock: {e}")
+            log.error("Error adding stock: %s", e)
             flash("Error adding stock to database.", "error")
             
     else:
@@ -303,8 +361,9 @@ def delete_stock():
     if stock_id_to_delete:
         try:
             supabase.table('stocks').delete().eq('id', stock_id_to_delete).eq('user_id', user_id).execute()
+            cache.delete_memoized(load_watchlist, user_id)
         except Exception as e:
-            print(f"Error deleting stock: {e}")
+            log.error("Error deleting stock: %s", e)
             
     return redirect(url_for('home'))
 
@@ -335,8 +394,9 @@ def add_alert():
                 'is_triggered': False,
                 'user_id': user_id
             }).execute()
+            cache.delete_memoized(load_watchlist, user_id)
         except Exception as e:
-            print(f"Error adding alert: {e}")
+            log.error("Error adding alert: %s", e)
     
     return redirect(url_for('home'))
 
@@ -352,13 +412,34 @@ def delete_alert():
     if alert_id:
         try:
             supabase.table('alerts').delete().eq('id', alert_id).eq('user_id', user_id).execute()
+            cache.delete_memoized(load_watchlist, user_id)
         except Exception as e:
-            print(f"Error deleting alert: {e}")
+            log.error("Error deleting alert: %s", e)
     
     return redirect(url_for('home'))
 
 
+# Scan alerts in the background so emails go out even when nobody has the page open
+scheduler = BackgroundScheduler(daemon=True)
+
+def start_scheduler():
+    """Adds the background jobs and starts the scheduler; call once per serving process."""
+    if scheduler.running:
+        return
+    if SETTINGS.alert_check_secs:
+        scheduler.add_job(
+            check_all_alerts, 'interval', seconds=SETTINGS.alert_check_secs,
+            id='check_all_alerts', max_instances=1, coalesce=True
+        )
+    # Load the ticker list right away, then refresh it daily
+    scheduler.add_job(refresh_us_symbols, 'interval', days=1, id='refresh_us_symbols', next_run_time=datetime.now())
+    scheduler.start()
+
+
 if __name__ == '__main__':
+    # The debug reloader imports this file twice; only its serving child runs the jobs
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_scheduler()
     app.run(debug=True)
 
 # Secret route to be run by UptimeRobot
@@ -367,8 +448,16 @@ def run_alert_check():
 
     secret = request.args.get('secret')
 
-    if secret == os.getenv('CRON_SECRET'):
-        check_all_alerts()
-        return "Alert check finished.", 200
+    if SETTINGS.cron_secret and secret == SETTINGS.cron_secret:
+        # No scheduler in this process (flask run, other WSGI servers): scan inline as before
+        if not scheduler.running:
+            check_all_alerts()
+            return "Alert check finished.", 200
+        # Hand the scan to the scheduler thread so the caller gets an answer right away
+        if scheduler.get_job('check_all_alerts'):
+            scheduler.modify_job('check_all_alerts', next_run_time=datetime.now())
+        else:
+            scheduler.add_job(check_all_alerts, id='run_alert_check', replace_existing=True)
+        return "Alert check queued.", 202
     else:
         return "Error: Invalid secret key.", 403
\ No newline at end of file
@@ -1,93 +1,171 @@
-import os
+import logging
+import time
+import threading
+import operator
+import jinja2
+import orjson
 import requests
-from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from ratelimit import limits, sleep_and_retry
+from config import SETTINGS, quote_ttl
 from supabase import create_client, Client
 import brevo_python
 from brevo_python.rest import ApiException
 from brevo_python.models.send_smtp_email import SendSmtpEmail
 
-# Load Environment
-load_dotenv()
+log = logging.getLogger(__name__)
 
-FINNHUB_API_KEY = os.getenv('FINNHUB_API_KEY')
 FINNHUB_BASE_URL = 'https://finnhub.io/api/v1'
-SUPABASE_URL = os.getenv('SUPABASE_URL')
-SUPABASE_KEY = os.getenv('SUPABASE_KEY')
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-BREVO_API_KEY = os.getenv('BREVO_API_KEY')
-BREVO_SENDER = os.getenv('BREVO_SENDER')
+# Quote URL with the token baked in; only the symbol is filled per call
+_QUOTE_URL = f'{FINNHUB_BASE_URL}/quote?symbol={{symbol}}&token={SETTINGS.finnhub_api_key}'
+# Keep-alive session so back-to-back quote calls reuse one TLS connection
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10, pool_maxsize=20,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+supabase: Client = create_client(SETTINGS.supabase_url, SETTINGS.supabase_key)
+_SENDER = {"email": SETTINGS.brevo_sender, "name": "MAP Alert"}
 
 # Configure Brevo API
 configuration = brevo_python.Configuration()
-configuration.api_key['api-key'] = BREVO_API_KEY
+configuration.api_key['api-key'] = SETTINGS.brevo_api_key
 api_instance = brevo_python.TransactionalEmailsApi(brevo_python.ApiClient(configuration))
 
+# 'high' alerts fire at or above the target, 'low' alerts at or below it
+_TRIGGER_CMP = {'high': operator.ge, 'low': operator.le}
+
+# Emails go out in the background so the alert loop never waits on Brevo
+_MAIL_POOL = ThreadPoolExecutor(max_workers=8)
+
+# Quotes are reused for 45s during market hours so repeated checks of a symbol don't refetch it
+QUOTE_TTL_SECS = 45
+_QUOTE_CACHE = {}  # symbol -> (fetched at, quote)
+_QUOTE_STATS = {'hits': 0, 'misses': 0}
+_QUOTE_LOCK = threading.Lock()
+
 # Fetch Stock Quote Function
 def get_stock_quote(symbol):
     """Fetches stock quote data from Finnhub API."""
+    with _QUOTE_LOCK:
+        cached = _QUOTE_CACHE.get(symbol)
+        fresh = cached and time.monotonic() - cached[0] < quote_ttl(QUOTE_TTL_SECS)
+        _QUOTE_STATS['hits' if fresh else 'misses'] += 1
+    if fresh:
+        return cached[1]
+
     try:
-        url = f'{FINNHUB_BASE_URL}/quote?symbol={symbol}&token={FINNHUB_API_KEY}'
-        response = requests.get(url)
+        url = _QUOTE_URL.format(symbol=symbol)
+        response = SESSION.get(url, timeout=(2, 5))
         response.raise_for_status() 
-        data = response.json()
+        data = orjson.loads(response.content)
         if data.get('c') == 0 and data.get('h') == 0:
             return {'symbol': symbol, 'error': 'No valid price data found for ticker.'}
-        return {'symbol': symbol, 'current_price': data.get('c')}
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching quote for {symbol}: {e}")
+        quote = {'symbol': symbol, 'current_price': data.get('c')}
+        with _QUOTE_LOCK:
+            _QUOTE_CACHE[symbol] = (time.monotonic(), quote)
+        return quote
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        log.error("Error fetching quote for %s: %s", symbol, e)
         return {'symbol': symbol, 'error': 'Failed to fetch quote'}
 
-def send_email_alert(target_email, symbol, name, alert_type, current_price, target_price):
-    """Builds and sends an HTML email alert using the Brevo API."""
-    if not BREVO_API_KEY or not BREVO_SENDER or not target_email:
-        print(f"Skipping email for {symbol}: Missing Brevo keys or target email.")
-        return
+def get_stock_quotes_bulk(symbols):
+    """Fetches quotes for a list of symbols, returned as a {symbol: quote} dict."""
+    if not symbols:
+        return {}
+    # Finnhub has no multi-symbol quote endpoint, so issue the single calls concurrently
+    with ThreadPoolExecutor(max_workers=min(16, len(symbols))) as executor:
+        return dict(zip(symbols, executor.map(get_stock_quote, symbols)))
 
-    if alert_type == 'high':
-        subject = f"✅ High Price Alert for {symbol}!"
-        color, alert_text = "#4CAF50", "hit high target"
-    else:
-        subject = f"🔻 Low Price Alert for {symbol}!"
-        color, alert_text = "#dc3545", "hit low target"
-        
-    html_content = f"""
+# Alert email body, compiled once at import; autoescape keeps stock names from injecting markup
+_ALERT_TMPL = jinja2.Template("""
     <html><body><div style="font-family: Arial, sans-serif; max-width: 600px; margin: auto; padding: 20px; border: 1px solid #ddd; border-radius: 10px;">
       <h2 style="color: #333; text-align: center;">Many As Penny Alert!</h2>
-      <h3 style="color: {color}; text-align: center;">{symbol} ({name}) {alert_text}</h3>
-      <p>This is an automated alert to let you know that <strong>{symbol}</strong> has reached a price of <strong>${current_price:,.2f}</strong>.</p>
+      <h3 style="color: {{ color }}; text-align: center;">{{ symbol }} ({{ name }}) {{ alert_text }}</h3>
+      <p>This is an automated alert to let you know that <strong>{{ symbol }}</strong> has reached a price of <strong>${{ "{:,.2f}".format(current_price) }}</strong>.</p>
       <div style="background-color: #f9f9f9; padding: 15px; border-radius: 5px; text-align: center;">
-        <p><strong>Target Price:</strong> ${target_price:,.2f}</p>
-        <p style="color: {color};"><strong>Current Price:</strong> ${current_price:,.2f}</p>
+        <p><strong>Target Price:</strong> ${{ "{:,.2f}".format(target_price) }}</p>
+        <p style="color: {{ color }};"><strong>Current Price:</strong> ${{ "{:,.2f}".format(current_price) }}</p>
       </div></div></body></html>
-    """
+    """, autoescape=True)
+
+# Per alert type: subject line, accent color and headline text
+_ALERT_STYLES = {
+    'high': ("✅ High Price Alert for {symbol}!", "#4CAF50", "hit high target"),  # Green
+    'low': ("🔻 Low Price Alert for {symbol}!", "#dc3545", "hit low target"),  # Red
+}
+
+# Stay under Brevo's per-minute send quota; callers wait for a free slot
+BREVO_SENDS_PER_MINUTE = 100
+BREVO_MAX_ATTEMPTS = 3
+
+@sleep_and_retry
+@limits(calls=BREVO_SENDS_PER_MINUTE, period=60)
+def _send_transac_email(send_smtp_email):
+    """Sends one transactional email through Brevo, throttled to the quota."""
+    return api_instance.send_transac_email(send_smtp_email)
+
+def send_email_alert(target_email, symbol, name, alert_type, current_price, target_price):
+    """Builds and sends an HTML email alert using the Brevo API."""
+    if not SETTINGS.brevo_enabled or not target_email:
+        log.info("Skipping email for %s: Missing Brevo keys or target email.", symbol)
+        return
+
+    subject, color, alert_text = _ALERT_STYLES.get(alert_type, _ALERT_STYLES['low'])
+    subject = subject.format(symbol=symbol)
+        
+    html_content = _ALERT_TMPL.render(
+        color=color, symbol=symbol, name=name, alert_text=alert_text,
+        current_price=current_price, target_price=target_price
+    )
     
     send_smtp_email = SendSmtpEmail(
         to=[{"email": target_email}],
-        sender={"email": BREVO_SENDER, "name": "MAP Alert"},
+        sender=_SENDER,
         subject=subject,
         html_content=html_content
     )
     
-    try:
-        api_response = api_instance.send_transac_email(send_smtp_email)
-        print(f"Email sent via Brevo API to {target_email}. Message ID: {api_response.message_id}")
-    except ApiException as e:
-        print(f"Error: Unable to send Brevo email. {e}")
+    for attempt in range(BREVO_MAX_ATTEMPTS):
+        try:
+            api_response = _send_transac_email(send_smtp_email)
+            log.info("Email sent via Brevo API to %s. Message ID: %s", target_email, api_response.message_id)
+            return
+        except ApiException as e:
+            # Brevo answers 429 when throttled; back off exponentially and try again
+            if e.status == 429 and attempt < BREVO_MAX_ATTEMPTS - 1:
+                time.sleep(2 ** attempt)
+                continue
+            log.error("Unable to send Brevo email. %s", e)
+            return
+
+def _log_send_failure(future):
+    """Reports any unexpected error raised by a background email send."""
+    error = future.exception()
+    if error:
+        log.error("Background email send failed. %s", error)
 
 # Check Alerts Function
 def check_all_alerts():
     """The main function for the Cron Job."""
-    print("Cron job started: Checking for triggered alerts...")
+    log.info("Cron job started: Checking for triggered alerts...")
     
     response = supabase.table('alerts').select('*, stocks(symbol, name)').eq('is_triggered', False).execute()
     alerts = response.data
     
     if not alerts:
-        print("No active alerts to check. Job finished.")
+        log.info("No active alerts to check. Job finished.")
         return
         
-    print(f"Found {len(alerts)} active alerts to check.")
+    log.info("Found %d active alerts to check.", len(alerts))
     
+    # Fetch each distinct symbol once up front; many alerts can share a stock
+    symbols = list({alert['stocks']['symbol'] for alert in alerts if alert.get('stocks')})
+    quotes = get_stock_quotes_bulk(symbols)
+    
+    triggered = []
     for alert in alerts:
         stock_info = alert.get('stocks')
         if not stock_info:
@@ -96,29 +174,46 @@ def check_all_alerts():
         symbol = stock_info['symbol']
         name = stock_info['name']
         
-        quote = get_stock_quote(symbol)
-        if quote.get('error') or quote.get('current_price') is None:
+        quote = quotes[symbol]
+        if quote.get('error') or quote.get('current_price') is None or alert['target_price'] is None:
             continue 
 
         current_price = quote['current_price']
-        is_triggered = False
-
-        if alert['alert_type'] == 'high' and current_price >= alert['target_price']:
-            is_triggered = True
-        elif alert['alert_type'] == 'low' and current_price <= alert['target_price']:
-            is_triggered = True
+        compare = _TRIGGER_CMP.get(alert['alert_type'])
+        is_triggered = compare is not None and compare(current_price, alert['target_price'])
             
         if is_triggered:
-            print(f"TRIGGERED: {symbol} at ${current_price}. Target was {alert['alert_type']} ${alert['target_price']}. Sending email...")
-            
-            send_email_alert(
-                alert['alert_email'], symbol, name,
-                alert['alert_type'], current_price, alert['target_price']
+            log.info(
+                "TRIGGERED: %s at $%s. Target was %s $%s. Sending email...",
+                symbol, current_price, alert['alert_type'], alert['target_price']
             )
-            
-            supabase.table('alerts').update({'is_triggered': True}).eq('id', alert['id']).execute()
+            triggered.append((alert, symbol, name, current_price))
+
+    claimed_ids = set()
+    if triggered:
+        # Claim every fired alert in one round-trip before any email is queued, so a failure resends nothing.
+        # Only rows still untriggered come back, so a concurrent scan (another worker) can't email them twice.
+        triggered_ids = [alert['id'] for alert, *_ in triggered]
+        claimed = (
+            supabase.table('alerts').update({'is_triggered': True})
+            .eq('is_triggered', False).in_('id', triggered_ids).execute()
+        )
+        claimed_ids = {row['id'] for row in claimed.data}
+
+    for alert, symbol, name, current_price in triggered:
+        if alert['id'] not in claimed_ids:
+            log.info("Skipping email for %s: alert %s was claimed by another scan.", symbol, alert['id'])
+            continue
+        future = _MAIL_POOL.submit(
+            send_email_alert,
+            alert['alert_email'], symbol, name,
+            alert['alert_type'], current_price, alert['target_price']
+        )
+        future.add_done_callback(_log_send_failure)
 
-    print("Cron job finished.")
+    log.info("Quote cache so far: %d hits, %d misses.", _QUOTE_STATS['hits'], _QUOTE_STATS['misses'])
+    log.info("Cron job finished.")
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     check_all_alerts()
\ No newline at end of file
@@ -0,0 +1,61 @@
+import os
+from dataclasses import dataclass
+from datetime import datetime, time as dt_time
+from zoneinfo import ZoneInfo
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """Environment configuration, read and parsed once at startup."""
+    finnhub_api_key: str
+    supabase_url: str
+    supabase_key: str
+    secret_key: str | None = None  # Required by app.py only; the cron runs without it
+    brevo_api_key: str | None = None
+    brevo_sender: str | None = None  # Validated 'From' email
+    cron_secret: str | None = None
+    quote_ttl_secs: int = 15
+    closed_quote_ttl_secs: int = 600  # Used for every cached quote while the US market is closed
+    alert_check_secs: int = 30  # 0 turns off the in-process alert scan
+    log_level: str | None = None  # None when LOG_LEVEL is unset
+
+    @property
+    def brevo_enabled(self):
+        return bool(self.brevo_api_key and self.brevo_sender)
+
+def load_settings():
+    """Builds Settings from the environment, failing fast if a required key is missing."""
+    required = ('FINNHUB_API_KEY', 'SUPABASE_URL', 'SUPABASE_KEY')
+    missing = [name for name in required if not os.getenv(name)]
+    if missing:
+        raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+
+    return Settings(
+        finnhub_api_key=os.getenv('FINNHUB_API_KEY'),
+        supabase_url=os.getenv('SUPABASE_URL'),
+        supabase_key=os.getenv('SUPABASE_KEY'),
+        secret_key=os.getenv('SECRET_KEY'),
+        brevo_api_key=os.getenv('BREVO_API_KEY'),
+        brevo_sender=os.getenv('BREVO_SENDER'),
+        cron_secret=os.getenv('CRON_SECRET'),
+        quote_ttl_secs=int(os.getenv('QUOTE_TTL_SECS', '15')),
+        closed_quote_ttl_secs=int(os.getenv('CLOSED_QUOTE_TTL_SECS', '600')),
+        alert_check_secs=int(os.getenv('ALERT_CHECK_SECS', '30')),
+        log_level=os.getenv('LOG_LEVEL', '').upper() or None,
+    )
+
+SETTINGS = load_settings()
+
+# Outside US market hours prices don't move, so cached quotes can live much longer
+MARKET_TZ = ZoneInfo('America/New_York')
+MARKET_OPEN, MARKET_CLOSE = dt_time(9, 30), dt_time(16, 0)
+
+def quote_ttl(open_ttl):
+    """Returns how long a cached quote stays fresh: open_ttl while the US market is open."""
+    now = datetime.now(MARKET_TZ)
+    if now.weekday() >= 5 or not MARKET_OPEN <= now.time() < MARKET_CLOSE:
+        return SETTINGS.closed_quote_ttl_secs
+    return open_ttl
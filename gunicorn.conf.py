@@ -0,0 +1,17 @@
+import os
+
+# The app spends nearly all of its time waiting on Supabase, Finnhub and Brevo,
+# so gevent workers serve many requests at once. The gevent worker monkey-patches
+# sockets before app.py is imported, so requests and supabase become cooperative.
+worker_class = 'gevent'
+worker_connections = 1000
+
+# Each worker runs its own alert scheduler; scans claim alerts atomically, so extra workers can't double-send
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+def post_worker_init(worker):
+    # Start the background jobs in each worker only, never in the master or on a bare import
+    from app import start_scheduler
+    start_scheduler()
@@ -0,0 +1,17 @@
+-- add_stock upserts with on_conflict (user_id, symbol), which needs a matching unique index.
+-- The old select-then-insert could race and store a symbol twice for one user, so first
+-- move alerts onto the oldest copy of each duplicated stock, then drop the other copies.
+with ranked as (
+    select id, first_value(id) over (partition by user_id, symbol order by id) as keep_id
+    from public.stocks
+)
+update public.alerts al
+set stock_id = ranked.keep_id
+from ranked
+where al.stock_id = ranked.id and ranked.id <> ranked.keep_id;
+
+delete from public.stocks a
+using public.stocks b
+where a.user_id = b.user_id and a.symbol = b.symbol and a.id > b.id;
+
+create unique index if not exists stocks_user_id_symbol_key on public.stocks (user_id, symbol);